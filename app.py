@@ -1,16 +1,36 @@
+import os
+import shelve
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 import pandas as pd
+import numpy as np
 import folium
 from streamlit_folium import st_folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 import plotly.express as px
-from geopy.distance import geodesic
 from geopy.geocoders import Nominatim
 import openrouteservice
+from scipy.spatial import cKDTree
+from rapidfuzz import fuzz, process
 
 # --- 1. CONFIGURATION & SETUP ---
 st.set_page_config(page_title="N-H Facilities Engine", page_icon="🏥", layout="wide")
 
+# Source CSV and the typed Parquet copy written on first load
+DATA_CSV = "nigeria_health_facilities.csv"
+DATA_PARQUET = "nigeria_health_facilities.parquet"
+
+# Marker cap for the Map Explorer; larger selections are sampled down
+MAX_MARKERS = 2000
+
+EARTH_RADIUS_KM = 6371.0
+
+# Persistent geocode cache and Nominatim's 1 request/second usage policy
+GEOCACHE_PATH = "geocache.db"
+NOMINATIM_MIN_INTERVAL = 1.0
+
 # Custom CSS
 st.markdown("""
     <style>
@@ -40,31 +60,192 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 2. DATA LOADING ---
-@st.cache_data
+@st.cache_resource
 def load_data():
+    # read-only — do not mutate; cache_resource hands every session the same object
     # REMOVED 'func_stats' to match your specific CSV version
     cols = ['facility_name', 'facility_level', 'ownership', 'ward', 'lga', 'state', 'latitude', 'longitude']
     try:
-        df = pd.read_csv("nigeria_health_facilities.csv", usecols=cols)
+        if os.path.exists(DATA_PARQUET) and (
+            not os.path.exists(DATA_CSV) or os.path.getmtime(DATA_PARQUET) >= os.path.getmtime(DATA_CSV)
+        ):
+            try:
+                return pd.read_parquet(DATA_PARQUET, columns=cols)
+            except Exception:
+                pass  # corrupt file or changed columns: rebuild from the CSV
+        
+        df = pd.read_csv(DATA_CSV, usecols=cols)
         df = df.dropna(subset=['latitude', 'longitude'])
+        # float32 is ~1 m precision, plenty for map display
+        df = df.astype({'latitude': 'float32', 'longitude': 'float32'})
+        # Low-cardinality labels: filters and counts compare integer codes instead of strings
+        for c in ['state', 'lga', 'ownership', 'facility_level', 'ward']:
+            df[c] = df[c].astype('category')
+        # Write-then-rename so an interrupted write never leaves a truncated file in place
+        tmp_path = f"{DATA_PARQUET}.{os.getpid()}.tmp"
+        try:
+            df.to_parquet(tmp_path, compression='zstd')
+            os.replace(tmp_path, DATA_PARQUET)
+        except Exception:
+            # read-only deploys just parse the CSV each cold start
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
         return df
     except Exception as e:
         st.error(f"❌ Data Error: {e}")
         return pd.DataFrame()
 
+def build_popups(df):
+    # Whole-column string concatenation rather than one f-string per marker
+    gmaps_links = (
+        "https://www.google.com/maps/dir/?api=1&destination="
+        + df['latitude'].astype(str) + "," + df['longitude'].astype(str)
+    )
+    return (
+        '<div style="font-family:sans-serif; width:180px;"><b>' + df['facility_name'].astype(str)
+        + '</b><br><span style="color:grey;">' + df['facility_level'].astype(str)
+        + '</span><br><a href="' + gmaps_links + '" target="_blank" '
+        + 'style="background-color:#4285F4; color:white; padding:6px 10px; text-decoration:none; border-radius:4px; font-weight:bold;">'
+        + 'Navigate</a></div>'
+    ).to_numpy()
+
+@st.cache_resource
+def build_state_index(_df):
+    # One slice per state, built once instead of re-masking the full table every rerun
+    if _df.empty:
+        return {}
+    index = {}
+    for s, g in _df.groupby('state', observed=True):
+        g = g.reset_index(drop=True)
+        # Drop other states' labels so value_counts/charts only show this state
+        for c in g.select_dtypes('category').columns:
+            g[c] = g[c].cat.remove_unused_categories()
+        # float64 rounded to the source's 5 decimals, so marker JSON doesn't carry float32 noise
+        lat = np.round(g['latitude'].to_numpy(dtype=float), 5)
+        lon = np.round(g['longitude'].to_numpy(dtype=float), 5)
+        # Equirectangular projection about the state's mean latitude, in km
+        cos_lat0 = np.cos(np.radians(lat.mean()))
+        tree = cKDTree(np.c_[np.radians(lat), np.radians(lon) * cos_lat0] * EARTH_RADIUS_KM)
+        # LGA and ward centroids for answering geocode queries locally (LGA wins on name clashes)
+        places = pd.concat([
+            g.groupby(c, observed=True)[['latitude', 'longitude']].mean().rename(index=lambda n: str(n).lower())
+            for c in ['lga', 'ward']
+        ])
+        places = places[~places.index.duplicated()]
+        index[s] = {
+            'df': g, 'lat': lat, 'lon': lon, 'cos_lat0': cos_lat0, 'tree': tree,
+            'name': g['facility_name'].astype(str).to_numpy(),
+            'popup': build_popups(g),
+            'public': (g['ownership'] == "Public").to_numpy(),
+            'place_names': places.index.tolist(),
+            'place_coords': places.to_numpy(dtype=float),
+        }
+    return index
+
 data = load_data()
+state_index = build_state_index(data)
 
 # --- 3. HELPER FUNCTIONS ---
 
-def get_coordinates(address):
-    geolocator = Nominatim(user_agent="naija_health_mapper_fixed")
+# Builds each marker client-side from a [lat, lon, popup_html, is_public, name] row;
+# the two icons are created once and shared by every marker
+MARKER_CALLBACK = """
+(function () {
+    var publicIcon = L.AwesomeMarkers.icon({icon: 'plus', prefix: 'fa', markerColor: 'green'});
+    var otherIcon = L.AwesomeMarkers.icon({icon: 'plus', prefix: 'fa', markerColor: 'red'});
+    return function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: row[3] ? publicIcon : otherIcon});
+        marker.bindPopup(row[2], {maxWidth: 250});
+        marker.bindTooltip(row[4]);
+        return marker;
+    };
+})()
+"""
+
+def haversine_km(lat, lon, lats, lons):
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(a))
+
+def nearest_facilities(entry, lat, lon, k=5):
+    # KD-tree lookup on the projected coords. The projection is a few % off east-west,
+    # so over-fetch, re-rank by exact haversine and keep the first k
+    n = len(entry['df'])
+    user_xy = np.array([np.radians(lat), np.radians(lon) * entry['cos_lat0']]) * EARTH_RADIUS_KM
+    _, idx = entry['tree'].query(user_xy, k=min(3 * k, n))
+    idx = np.atleast_1d(idx)
+    dist = haversine_km(lat, lon, entry['lat'][idx], entry['lon'][idx])
+    order = np.argsort(dist)[:k]
+    nearest = entry['df'].iloc[idx[order]].copy()
+    nearest['geo_dist'] = dist[order]
+    return nearest
+
+@st.cache_resource
+def get_geocache():
+    # Shared by all sessions; the lock guards the shelf and spaces out Nominatim calls
     try:
-        location = geolocator.geocode(f"{address}, Nigeria")
+        shelf = shelve.open(GEOCACHE_PATH)
+    except Exception:
+        shelf = None  # unwritable working dir: rely on the in-memory st.cache_data layer
+    return {'shelf': shelf, 'lock': threading.Lock(), 'last_call': 0.0}
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def geocode_cached(address, state):
+    key = f"{address}|{state}".lower().strip()
+    cache = get_geocache()
+    shelf = cache['shelf']
+    with cache['lock']:
+        if shelf is not None:
+            try:
+                if key in shelf:
+                    return shelf[key]
+            except Exception:
+                pass  # unreadable entry; just ask Nominatim
+        
+        wait = NOMINATIM_MIN_INTERVAL - (time.monotonic() - cache['last_call'])
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            geolocator = Nominatim(user_agent="naija_health_mapper_fixed")
+            location = geolocator.geocode(f"{address}, {state}, Nigeria")
+        finally:
+            cache['last_call'] = time.monotonic()
+        
         if location:
-            return location.latitude, location.longitude
+            coords = (location.latitude, location.longitude)
+            if shelf is not None:
+                try:
+                    shelf[key] = coords
+                    shelf.sync()
+                except Exception:
+                    pass  # a failed write only costs a future cache miss
+            return coords
+    return None, None
+
+def match_local_place(address, state):
+    # Whole-string match so landmarks like "Bodija Market, Ibadan" still go to Nominatim
+    entry = state_index.get(state)
+    if not entry:
+        return None
+    hit = process.extractOne(address.lower().strip(), entry['place_names'], scorer=fuzz.ratio, score_cutoff=85)
+    if hit:
+        return tuple(entry['place_coords'][hit[2]].tolist())
+    return None
+
+def get_coordinates(address, state):
+    local = match_local_place(address, state)
+    if local:
+        return local
+    # Errors aren't cached, so a network blip doesn't stick for a day
+    try:
+        return geocode_cached(address, state)
     except:
         return None, None
-    return None, None
 
 def get_drive_time(start_coords, end_coords, api_key):
     try:
@@ -81,6 +262,53 @@ def get_drive_time(start_coords, end_coords, api_key):
     except:
         return None, None
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def drive_matrix_cached(origin, destinations, api_key):
+    client = openrouteservice.Client(key=api_key)
+    matrix = client.distance_matrix(
+        locations=[list(origin)] + [list(d) for d in destinations],
+        profile='driving-car',
+        sources=[0],
+        destinations=list(range(1, len(destinations) + 1)),
+        metrics=['duration', 'distance']
+    )
+    return matrix['durations'][0], matrix['distances'][0]
+
+def get_drive_times(origin, destinations, api_key):
+    # One matrix request for every destination; origin rounded (~11 m) so repeat searches hit the cache
+    origin = (round(origin[0], 4), round(origin[1], 4))
+    try:
+        durations, distances = drive_matrix_cached(origin, tuple(destinations), api_key)
+    except:
+        # Matrix has its own ORS quota; fall back to directions calls, run concurrently
+        with ThreadPoolExecutor(max_workers=5) as ex:
+            return list(ex.map(lambda dest: get_drive_time(origin, dest, api_key), destinations))
+    return [
+        (dur / 60, dist / 1000) if dur is not None and dist is not None else (None, None)
+        for dur, dist in zip(durations, distances)
+    ]
+
+@st.cache_data
+def state_agg(state):
+    g = state_index[state]['df']
+    own = g['ownership'].value_counts().reset_index()
+    own.columns = ['ownership', 'count']
+    lvl = g['facility_level'].value_counts().reset_index()
+    lvl.columns = ['Level', 'Count']
+    lga = g['lga'].value_counts().reset_index()
+    lga.columns = ['LGA', 'Facilities']
+    return {'own': own, 'lvl': lvl, 'lga': lga}
+
+@st.cache_resource
+def state_figures(state):
+    # Figures are rebuilt only when a new state is picked, not on every widget change
+    agg = state_agg(state)
+    return {
+        'own': px.pie(agg['own'], names='ownership', values='count', hole=0.4),
+        'lvl': px.bar(agg['lvl'], x='Level', y='Count', color='Level'),
+        'lga': px.bar(agg['lga'], x='LGA', y='Facilities', color='Facilities'),
+    }
+
 # --- 4. MAIN APP UI ---
 
 st.title("Nigerian Health Infrastructure Engine")
@@ -96,58 +324,56 @@ if not data.empty:
         
         with col1:
             st.subheader("Filters")
-            states = sorted(data['state'].astype(str).unique())
+            states = sorted(data['state'].unique())
             selected_state = st.selectbox("Select State", states)
             
-            state_data = data[data['state'] == selected_state]
+            state_data = state_index[selected_state]['df']
             
-            lgas = sorted(state_data['lga'].astype(str).unique())
+            lgas = sorted(state_data['lga'].unique())
             selected_lga = st.multiselect("LGA (Optional)", lgas)
             
-            levels = state_data['facility_level'].unique()
+            levels = state_data['facility_level'].unique().tolist()
             selected_level = st.multiselect("Facility Level", levels)
             
-            map_df = state_data.copy()
-            if selected_lga: map_df = map_df[map_df['lga'].isin(selected_lga)]
-            if selected_level: map_df = map_df[map_df['facility_level'].isin(selected_level)]
+            mask = np.ones(len(state_data), dtype=bool)
+            if selected_lga: mask &= state_data['lga'].isin(selected_lga).to_numpy()
+            if selected_level: mask &= state_data['facility_level'].isin(selected_level).to_numpy()
+            map_df = state_data[mask] if (selected_lga or selected_level) else state_data
 
         with col2:
             m1, m2, m3 = st.columns(3)
             m1.metric("Total Facilities", len(map_df))
             if len(map_df) > 0:
-                public_pct = (len(map_df[map_df['ownership']=='Public']) / len(map_df)) * 100
+                public_pct = 100.0 * (map_df['ownership'] == 'Public').sum() / len(map_df)
                 m2.metric("Public Owned", f"{public_pct:.1f}%")
             m3.metric("Selected State", selected_state)
             
             if not map_df.empty:
                 avg_lat = map_df['latitude'].mean()
                 avg_lon = map_df['longitude'].mean()
-                m = folium.Map(location=[avg_lat, avg_lon], zoom_start=9)
-                marker_cluster = MarkerCluster().add_to(m)
+                # Fresh map each rerun: st_folium adds the marker group to it, so it can't be shared.
+                # Centre rounded so small filter changes keep the same base map and only swap markers
+                m = folium.Map(location=[round(float(avg_lat), 2), round(float(avg_lon), 2)], zoom_start=9)
                 
-                for _, row in map_df.iterrows():
-                    color = "green" if row['ownership'] == "Public" else "red"
-                    gmaps_link = f"https://www.google.com/maps/dir/?api=1&destination={row['latitude']},{row['longitude']}"
-                    
-                    popup_html = f"""
-                    <div style="font-family:sans-serif; width:180px;">
-                        <b>{row['facility_name']}</b><br>
-                        <span style="color:grey;">{row['facility_level']}</span><br>
-                        <a href="{gmaps_link}" target="_blank" 
-                           style="background-color:#4285F4; color:white; padding:6px 10px; text-decoration:none; border-radius:4px; font-weight:bold;">
-                           Navigate
-                        </a>
-                    </div>
-                    """
-                    
-                    folium.Marker(
-                        [row['latitude'], row['longitude']],
-                        popup=folium.Popup(popup_html, max_width=250),
-                        tooltip=row['facility_name'],
-                        icon=folium.Icon(color=color, icon="plus", prefix="fa")
-                    ).add_to(marker_cluster)
+                render_df = map_df
+                if len(map_df) > MAX_MARKERS:
+                    render_df = map_df.sample(MAX_MARKERS, random_state=0)
+                    st.info(f"Showing {MAX_MARKERS:,} of {len(map_df):,} facilities. Filter by LGA or level to see them all.")
                 
-                st_folium(m, width="100%", height=500)
+                # Popups etc. are precomputed per state; the frame index is the row position
+                entry = state_index[selected_state]
+                rows = render_df.index.to_numpy()
+                marker_rows = [
+                    list(r) for r in zip(
+                        entry['lat'][rows].tolist(), entry['lon'][rows].tolist(),
+                        entry['popup'][rows].tolist(), entry['public'][rows].tolist(), entry['name'][rows].tolist()
+                    )
+                ]
+                facilities = folium.FeatureGroup(name="Facilities")
+                FastMarkerCluster(data=marker_rows, callback=MARKER_CALLBACK).add_to(facilities)
+                
+                # Nothing reads map state back, so don't round-trip it (or rerun on pan/zoom)
+                st_folium(m, feature_group_to_add=facilities, width="100%", height=500, returned_objects=[])
             else:
                 st.warning("No facilities match filters.")
 
@@ -156,25 +382,23 @@ if not data.empty:
     # ==========================================
     with tab2:
         st.header(f"Healthcare Analytics: {selected_state}")
-        c1, c2 = st.columns(2)
+        # st.tabs runs every tab body on each rerun, so charts are opt-in
+        st.toggle("Show charts", key="tab2_open")
         
-        with c1:
-            st.subheader("Ownership Structure")
-            fig_pie = px.pie(state_data, names='ownership', hole=0.4)
-            st.plotly_chart(fig_pie, use_container_width=True)
+        if st.session_state.get('tab2_open'):
+            figs = state_figures(selected_state)
+            c1, c2 = st.columns(2)
             
-        with c2:
-            st.subheader("Facility Levels")
-            level_counts = state_data['facility_level'].value_counts().reset_index()
-            level_counts.columns = ['Level', 'Count']
-            fig_bar = px.bar(level_counts, x='Level', y='Count', color='Level')
-            st.plotly_chart(fig_bar, use_container_width=True)
-            
-        st.subheader("Density by LGA")
-        lga_counts = state_data['lga'].value_counts().reset_index()
-        lga_counts.columns = ['LGA', 'Facilities']
-        fig_lga = px.bar(lga_counts, x='LGA', y='Facilities', color='Facilities')
-        st.plotly_chart(fig_lga, use_container_width=True)
+            with c1:
+                st.subheader("Ownership Structure")
+                st.plotly_chart(figs['own'], use_container_width=True)
+                
+            with c2:
+                st.subheader("Facility Levels")
+                st.plotly_chart(figs['lvl'], use_container_width=True)
+                
+            st.subheader("Density by LGA")
+            st.plotly_chart(figs['lga'], use_container_width=True)
 
     # ==========================================
     # TAB 3: EMERGENCY FINDER
@@ -197,49 +421,45 @@ if not data.empty:
             
         if find_btn and user_loc:
             with st.spinner("Triangulating location..."):
-                u_lat, u_lon = get_coordinates(f"{user_loc}, {confirm_state}")
+                u_lat, u_lon = get_coordinates(user_loc, confirm_state)
+            
+            if u_lat is not None:
+                st.success(f"📍 Found: {u_lat:.4f}, {u_lon:.4f}")
                 
-                if u_lat:
-                    st.success(f"📍 Found: {u_lat:.4f}, {u_lon:.4f}")
+                # REMOVED filtering by 'func_stats' since the column is missing
+                candidates = state_index.get(confirm_state)
+                
+                if candidates is None or candidates['df'].empty:
+                    st.error("No facilities found in this state.")
+                else:
+                    top_5 = nearest_facilities(candidates, u_lat, u_lon, k=5)
+                    
+                    st.subheader("Top 5 Nearest Facilities")
                     
-                    # REMOVED filtering by 'func_stats' since the column is missing
-                    candidates = data[data['state'] == confirm_state].copy()
+                    drive_times = [(None, None)] * len(top_5)
+                    if user_api_key:
+                        with st.spinner("Fetching drive times..."):
+                            drive_times = get_drive_times(
+                                (u_lon, u_lat),
+                                list(zip(top_5['longitude'].tolist(), top_5['latitude'].tolist())),
+                                user_api_key
+                            )
                     
-                    if candidates.empty:
-                        st.error("No facilities found in this state.")
-                    else:
-                        candidates['geo_dist'] = candidates.apply(
-                            lambda row: geodesic((u_lat, u_lon), (row['latitude'], row['longitude'])).km, 
-                            axis=1
-                        )
-                        
-                        top_5 = candidates.sort_values('geo_dist').head(5)
-                        
-                        st.subheader("Top 5 Nearest Facilities")
-                        
-                        for _, row in top_5.iterrows():
-                            drive_mins, drive_km = None, None
-                            if user_api_key:
-                                drive_mins, drive_km = get_drive_time(
-                                    (u_lon, u_lat), 
-                                    (row['longitude'], row['latitude']), 
-                                    user_api_key
-                                )
+                    for (_, row), (drive_mins, drive_km) in zip(top_5.iterrows(), drive_times):
+                        with st.expander(f" {row['facility_name']} ({row['facility_level']})", expanded=True):
+                            k1, k2, k3 = st.columns(3)
                             
-                            with st.expander(f" {row['facility_name']} ({row['facility_level']})", expanded=True):
-                                k1, k2, k3 = st.columns(3)
+                            if drive_mins is not None:
+                                k1.metric("Est. Time", f"{drive_mins:.0f} mins")
+                                k2.metric("Drive Dist", f"{drive_km:.1f} km")
+                            else:
+                                k1.metric("Straight Line", f"{row['geo_dist']:.2f} km")
+                                k2.caption("Traffic data disabled")
                                 
-                                if drive_mins:
-                                    k1.metric("Est. Time", f"{drive_mins:.0f} mins")
-                                    k2.metric("Drive Dist", f"{drive_km:.1f} km")
-                                else:
-                                    k1.metric("Straight Line", f"{row['geo_dist']:.2f} km")
-                                    k2.caption("Traffic data disabled")
-                                    
-                                nav_link = f"https://www.google.com/maps/dir/?api=1&destination={row['latitude']},{row['longitude']}"
-                                k3.markdown(f'<a href="{nav_link}" target="_blank" class="nav-btn">🚗 GO NOW</a>', unsafe_allow_html=True)
-                else:
-                    st.error("Address not found. Try adding a landmark.")
+                            nav_link = f"https://www.google.com/maps/dir/?api=1&destination={row['latitude']},{row['longitude']}"
+                            k3.markdown(f'<a href="{nav_link}" target="_blank" class="nav-btn">🚗 GO NOW</a>', unsafe_allow_html=True)
+            else:
+                st.error("Address not found. Try adding a landmark.")
 
 else:
     st.info("Loading Database...")
\ No newline at end of file